@@ -1,16 +1,30 @@
 import os
 import re
-from openai import OpenAI
+import asyncio
+from openai import AsyncOpenAI, OpenAIError
 from pathlib import Path
 import yaml
 import json
+import functools
+import atexit
 import argparse
 import pyperclip  # To copy to clipboard
-import subprocess  # For downloading and running the Ollama model
-import shutil  # To check if commands are available
-import ollama
+import tempfile  # To spool streamed responses
+import hashlib  # To key cached responses on their inputs
+import shutil
+import uuid  # To name temporary output files
+import httpx  # To talk to the Ollama server
+from concurrent.futures import ThreadPoolExecutor
 # Constants
 CONFIG_FILE = 'config.yaml'
+IO_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+WRITE_BUFFER_SIZE = 64 * 1024
+ENCODE_SLICE_SIZE = 1024 * 1024
+WHITESPACE_PATTERN = re.compile(r'\s+')
+MARKER_PATTERN = re.compile(r'^(?:\[\d+\] )?#@(.*)$')  # #@{filename}, optionally after a [i] batch index
+CHARS_PER_TOKEN = 4  # Rough estimate used to size prompt batches
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)  # libyaml based loader when available
+OLLAMA_LIMITS = httpx.Limits(max_keepalive_connections=40, keepalive_expiry=30.0)
 DEFAULT_CONFIG = {
     'code_extensions': [
         '.py', '.js', '.java', '.cpp', '.cs', '.html', '.css',
@@ -28,20 +42,53 @@ DEFAULT_CONFIG = {
     'clipboard_mode': False,
     'local_llm': True,
     'results_file': 'results.txt',
-    'ollama_model': 'mistral'  # Placeholder for the actual best model name
+    'ollama_model': 'mistral',  # Placeholder for the actual best model name
+    'ollama_url': 'http://localhost:11434',
+    'ollama_context_tokens': 8192,
+    'max_concurrent_requests': 4,
+    'cache_dir': '.llm-cache',
+    'cache_max_size_mb': 100
 }
-
-
-# Load configuration from a YAML file, create a default one if not present
-def load_config():
+PROMPT_GUIDELINES = (
+    "You are an expert software engineer and architect. Your task is to review and refactor the entire project code "
+    "provided below to achieve the highest standards of code quality, maintainability, scalability, and performance. "
+    "Please follow these guidelines:\n"
+    "1. Use modern design patterns (such as MVC, microservices, or clean architecture) suitable for this project.\n"
+    "2. Ensure the code is modular, well-structured, and adheres to best practices for each programming language used.\n"
+    "3. Provide clear separation of concerns, with appropriate use of classes, methods, and modules.\n"
+    "4. Include error handling, input validation, and security best practices (e.g., sanitizing inputs, using prepared statements).\n"
+    "5. Make sure the code is optimized for performance, removing any redundant or inefficient operations.\n"
+    "6. Ensure compatibility with the latest versions of the frameworks or libraries used.\n"
+    "7. Include comprehensive comments and documentation for each class, method, and module to ensure readability and maintainability.\n"
+    "8. Output only code blocks using the format #@{filename} at the top of each block to indicate the file name.\n"
+    "9. Provide test cases or suggest how the code can be tested to ensure robustness and reliability.\n"
+    "10. Use clear, descriptive names for all variables, functions, and classes.\n"
+    "\nReview the code and provide your output below, using only code blocks with no explanations:\n\n"
+)
+BATCH_INSTRUCTIONS = (
+    "The files below are numbered [1], [2], ... in the order they are given. "
+    "Start each of your output blocks with the number of the file it refactors, e.g. [1] #@{filename}, "
+    "and keep the same order.\n"
+)
+
+
+# Read the YAML configuration file once per run, create a default one if not present
+@functools.lru_cache(maxsize=1)
+def read_config_file():
     if not os.path.exists(CONFIG_FILE):
         with open(CONFIG_FILE, 'w') as config_file:
             yaml.dump(DEFAULT_CONFIG, config_file)
         print(f"Configuration file created with default settings: {CONFIG_FILE}")
 
     with open(CONFIG_FILE, 'r') as config_file:
-        config = yaml.safe_load(config_file)
-    return config
+        return yaml.load(config_file, Loader=YAML_LOADER) or {}
+
+
+# Load configuration from a YAML file
+def load_config():
+    # Fall back to defaults for settings missing from older configuration files.
+    # A new dict is built every time, since callers update it with the CLI arguments.
+    return {**DEFAULT_CONFIG, **read_config_file()}
 
 
 # Load API key from a .secret file
@@ -66,6 +113,14 @@ def parse_args():
     parser.add_argument('--local_llm', action='store_true', help='Use local LLM (Ollama model) for code enhancement')
     parser.add_argument('--results_file', help='File to save results for later use')
     parser.add_argument('--ollama_model', help='Specify the Ollama model to use for local LLM')
+    parser.add_argument('--ollama_url', help='URL of the Ollama server used for local LLM')
+    parser.add_argument('--ollama_context_tokens', type=int,
+                        help='Context window size, in tokens, requested from the Ollama model')
+    parser.add_argument('--max_concurrent_requests', type=int,
+                        help='Maximum number of LLM requests to run at the same time')
+    parser.add_argument('--cache_dir', help='Directory where LLM responses are cached')
+    parser.add_argument('--cache_max_size_mb', type=int, help='Maximum size of the LLM response cache in MB')
+    parser.add_argument('--no_cache', action='store_true', help='Disable the LLM response cache')
     return parser.parse_args()
 
 
@@ -93,127 +148,440 @@ def merge_config_and_args(config, args):
         config['results_file'] = args.results_file
     if args.ollama_model:
         config['ollama_model'] = args.ollama_model
+    if args.ollama_url:
+        config['ollama_url'] = args.ollama_url
+    if args.ollama_context_tokens is not None:
+        config['ollama_context_tokens'] = args.ollama_context_tokens
+    if args.max_concurrent_requests is not None:
+        config['max_concurrent_requests'] = args.max_concurrent_requests
+    if args.cache_dir:
+        config['cache_dir'] = args.cache_dir
+    if args.cache_max_size_mb is not None:
+        config['cache_max_size_mb'] = args.cache_max_size_mb
+    if args.no_cache:
+        config['cache_dir'] = None
     return config
 
 
+# code_extensions is expected to be a set, so the lookup is a single hash probe
 def is_code_file(filename, code_extensions):
-    return any(filename.endswith(ext) for ext in code_extensions)
+    return os.path.splitext(filename)[1] in code_extensions
+
+
+def list_code_files(directory, code_extensions):
+    # Walk the tree with os.scandir, which reuses the file type returned by the directory listing
+    # Extensions may be given with or without the leading dot, e.g. --code_extensions py js
+    code_extensions = frozenset(ext if ext.startswith('.') else '.' + ext for ext in code_extensions)
+    directories = [directory]
+    while directories:
+        current_directory = directories.pop()
+        try:
+            entries = os.scandir(current_directory)
+        except OSError:
+            # Unreadable directories are skipped, as os.walk does
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif entry.is_file() and is_code_file(entry.name, code_extensions):
+                    yield entry.path
+
+
+# Thread pool used to read files, created on first use and shut down at exit
+@functools.lru_cache(maxsize=1)
+def io_pool():
+    pool = ThreadPoolExecutor(max_workers=IO_WORKERS)
+    atexit.register(pool.shutdown)
+    return pool
+
+
+def read_code_file(file_path):
+    # Read the whole file in one unbuffered call and decode it at once, instead of through a text wrapper.
+    # Newlines are not translated, which makes no difference once whitespace is collapsed.
+    with open(file_path, 'rb', buffering=0) as f:
+        return f.read().decode('utf-8', errors='replace')
 
 
-def read_and_concatenate_code_files(directory, code_extensions):
-    all_code_content = ""
-    for root, _, files in os.walk(directory):
-        for file in files:
-            if is_code_file(file, code_extensions):
-                with open(os.path.join(root, file), 'r', encoding='utf-8') as f:
-                    file_content = f.read()
-                    all_code_content += f"\n# {file}\n" + file_content
-    return all_code_content
+def iter_code_files(directory, code_extensions):
+    # Read files concurrently, but yield (file_path, file_content) pairs sorted by path, so runs are reproducible
+    file_paths = sorted(list_code_files(directory, code_extensions))
+    yield from zip(file_paths, io_pool().map(read_code_file, file_paths))
+
+
+def file_header(file_path):
+    return f"\n# {os.path.basename(file_path)}\n"
+
+
+def iter_code_chunks(directory, code_extensions):
+    for file_path, file_content in iter_code_files(directory, code_extensions):
+        yield file_header(file_path)
+        yield file_content
 
 
 def clean_code_content(content):
     # Remove multiple spaces and newlines
-    content = re.sub(r'\s+', ' ', content)
-    return content
-
-
-def generate_prompt(cleaned_code_content):
-    prompt = (
-        "You are an expert software engineer and architect. Your task is to review and refactor the entire project code "
-        "provided below to achieve the highest standards of code quality, maintainability, scalability, and performance. "
-        "Please follow these guidelines:\n"
-        "1. Use modern design patterns (such as MVC, microservices, or clean architecture) suitable for this project.\n"
-        "2. Ensure the code is modular, well-structured, and adheres to best practices for each programming language used.\n"
-        "3. Provide clear separation of concerns, with appropriate use of classes, methods, and modules.\n"
-        "4. Include error handling, input validation, and security best practices (e.g., sanitizing inputs, using prepared statements).\n"
-        "5. Make sure the code is optimized for performance, removing any redundant or inefficient operations.\n"
-        "6. Ensure compatibility with the latest versions of the frameworks or libraries used.\n"
-        "7. Include comprehensive comments and documentation for each class, method, and module to ensure readability and maintainability.\n"
-        "8. Output only code blocks using the format #@{filename} at the top of each block to indicate the file name.\n"
-        "9. Provide test cases or suggest how the code can be tested to ensure robustness and reliability.\n"
-        "10. Use clear, descriptive names for all variables, functions, and classes.\n"
-        "\nReview the code and provide your output below, using only code blocks with no explanations:\n\n"
-        f"{cleaned_code_content}"
-    )
-    return prompt
-
-
-def ask_openai_to_improve_code(client, prompt, model, max_tokens, temperature):
-    response = client.chat.completions.create(
-        model=model,
-        messages=[
-            {"role": "user", "content": prompt}
-        ],
-        max_tokens=max_tokens,
-        temperature=temperature,
-    )
-    return response.choices[0].message.content
-
-
-def use_local_llm(prompt, model):
-    # This function assumes Ollama command-line tool is available
+    return WHITESPACE_PATTERN.sub(' ', content)
+
+
+def clean_code_chunks(chunks):
+    # Same as clean_code_content, but carries whitespace runs across chunk boundaries
+    previous_ends_with_space = False
+    for chunk in chunks:
+        chunk = clean_code_content(chunk)
+        if previous_ends_with_space and chunk.startswith(' '):
+            chunk = chunk[1:]
+        if chunk:
+            previous_ends_with_space = chunk.endswith(' ')
+            yield chunk
+
+
+# Yield the prompt guidelines followed by the cleaned code chunks, without building the prompt in memory
+def generate_prompt_chunks(cleaned_code_chunks):
+    yield PROMPT_GUIDELINES
+    yield from cleaned_code_chunks
+
+
+# Yield the batch instructions followed by each cleaned file, numbered by its position in the batch
+def iter_batch_chunks(batch):
+    yield BATCH_INSTRUCTIONS
+    for index, (file_name, cleaned_file_content) in enumerate(batch, start=1):
+        yield f"\n[{index}] #@{file_name}\n"
+        yield cleaned_file_content
+
+
+def generate_batch_prompts(directory, code_extensions, max_prompt_tokens):
+    """
+    Pack the code files into as few prompts as possible, each staying under max_prompt_tokens (estimated),
+    so the LLM can process several files per request while leaving room in the context window for the output.
+    A file larger than the limit gets a prompt of its own.
+    Files are packed in path order and named by their path relative to directory, so files sharing a name
+    in different folders get separate outputs. Since packing is greedy, a file whose size changes may move
+    the boundaries of the batches after it, and those batches then miss the response cache.
+    """
+    max_batch_length = max_prompt_tokens * CHARS_PER_TOKEN
+    prompts = []
+    batch = []
+    batch_length = 0
+    for file_path, file_content in iter_code_files(directory, code_extensions):
+        cleaned_file_content = clean_code_content(file_content)
+        if batch and batch_length + len(cleaned_file_content) > max_batch_length:
+            prompts.append("".join(generate_prompt_chunks(iter_batch_chunks(batch))))
+            batch = []
+            batch_length = 0
+        batch.append((os.path.relpath(file_path, directory), cleaned_file_content))
+        batch_length += len(cleaned_file_content)
+    if batch:
+        prompts.append("".join(generate_prompt_chunks(iter_batch_chunks(batch))))
+    return prompts
+
+
+# Hash everything that influences an LLM response, so unchanged prompts can reuse a cached one
+def cache_key(*parts):
+    digest = hashlib.blake2b(digest_size=32)
+    for part in parts:
+        digest.update(str(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+# Return the path of a cached response, or None when caching is disabled or the response is not cached
+def find_cached_response(cache_dir, key):
+    if not cache_dir:
+        return None
+    cached_path = os.path.join(cache_dir, f"{key}.txt")
+    try:
+        # Refresh the modification time, which is used as the last access time for eviction
+        os.utime(cached_path)
+    except FileNotFoundError:
+        return None
+    return cached_path
+
+
+# Cache a response given as a string or a readable text file
+def store_cached_response(cache_dir, key, content):
+    if not cache_dir:
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write to a temporary file and rename it, so readers never see a partial response
+    fd, temp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
     try:
-        # Check if Ollama is installed
-        if shutil.which("ollama") is None:
-            raise EnvironmentError("Ollama command-line tool is not installed. Please install it to proceed.")
+        with open(fd, 'w', encoding='utf-8') as f:
+            if isinstance(content, str):
+                f.write(content)
+            else:
+                shutil.copyfileobj(content, f)
+        os.replace(temp_path, os.path.join(cache_dir, f"{key}.txt"))
+    except BaseException:
+        # evict_cache only looks at finished entries, so a leftover temporary file would never be removed
+        os.remove(temp_path)
+        raise
+
+
+# Remove the least recently used responses until the cache fits in max_size_mb
+def evict_cache(cache_dir, max_size_mb):
+    if not cache_dir or not os.path.isdir(cache_dir):
+        return
+    with os.scandir(cache_dir) as entries:
+        cached_files = [(entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                        for entry in entries if entry.name.endswith('.txt')]
+    cache_size = sum(size for _, size, _ in cached_files)
+    max_size = max_size_mb * 1024 * 1024
+    for _, size, path in sorted(cached_files):
+        if cache_size <= max_size:
+            break
+        os.remove(path)
+        cache_size -= size
+
+
+async def ask_openai_to_improve_code(client, prompts, model, max_tokens, temperature, max_concurrent_requests,
+                                     cache_dir):
+    semaphore = asyncio.Semaphore(max_concurrent_requests)
+
+    async def ask(prompt):
+        key = cache_key('openai', model, max_tokens, temperature, prompt)
+        cached_path = find_cached_response(cache_dir, key)
+        if cached_path:
+            with open(cached_path, 'r', encoding='utf-8') as f:
+                return f.read()
+
+        async with semaphore:
+            response = await client.chat.completions.create(
+                model=model,
+                messages=[
+                    {"role": "user", "content": prompt}
+                ],
+                max_tokens=max_tokens,
+                temperature=temperature,
+            )
+        content = response.choices[0].message.content
+        store_cached_response(cache_dir, key, content)
+        return content
+
+    # Let every request finish, so a failing batch (rate limit, timeout, ...) does not discard the others
+    results = await asyncio.gather(*(ask(prompt) for prompt in prompts), return_exceptions=True)
+
+    # Responses are returned in the same order as the prompts, leaving out the failed ones
+    responses = []
+    for index, result in enumerate(results, start=1):
+        if isinstance(result, OpenAIError):
+            print(f"Error calling the OpenAI API on prompt {index}/{len(prompts)}: {result}")
+        elif isinstance(result, BaseException):
+            raise result
+        else:
+            responses.append(result)
+    return responses
 
-        # Download the model if not cached
-        ollama.pull(model)
-        result=[]
-        prompt = prompt[:100]
-        stream = ollama.chat(
-            model=model,
-            messages=[{'role': 'user', 'content': prompt}],
-            stream=True,
-        )
 
-        for chunk in stream:
-            print(chunk['message']['content'], end='', flush=True)
-            result.append(chunk['message']['content'])
+class ResultFilesWriter:
+    """
+    Parser for the #@{filename} blocks of the LLM output, used by save_results and while streaming responses.
+    The output can be fed in arbitrary chunks, and each block is written to its file line by line.
+    Lines end with LF or CRLF; other line separators are kept as part of the line.
+    Files are written next to their target under a temporary name, and only replace it once close() is called,
+    so abort() can leave output_directory untouched when the output turns out to be incomplete.
+    """
 
-        return "".join(result)
+    def __init__(self, output_directory):
+        self.output_directory = output_directory
+        self.pending_line = ""
+        self.current_file = None
+        self.at_file_start = True
+        self.written_files = []  # (temporary path, file path) pairs, moved into place by close()
+
+    def feed(self, text):
+        lines = (self.pending_line + text).split("\n")
+        self.pending_line = lines.pop()
+        for line in lines:
+            # Drop the first half of a CRLF line break
+            self._write_line(line[:-1] if line.endswith("\r") else line)
+
+    def close(self):
+        if self.pending_line:
+            self._write_line(self.pending_line)
+            self.pending_line = ""
+        self._close_current_file()
+        for temp_path, file_path in self.written_files:
+            os.replace(temp_path, file_path)
+        self.written_files = []
+
+    def abort(self):
+        self.pending_line = ""
+        self._close_current_file()
+        for temp_path, _ in self.written_files:
+            os.remove(temp_path)
+        self.written_files = []
+
+    def _write_line(self, line):
+        marker = MARKER_PATTERN.match(line)
+        if marker:
+            # Start a new file
+            self._close_current_file()
+            current_file = marker.group(1).strip()  # Extract filename after #@
+            if current_file:
+                file_path = os.path.join(self.output_directory, current_file)
+                Path(os.path.dirname(file_path)).mkdir(parents=True, exist_ok=True)
+                temp_path = f"{file_path}.{uuid.uuid4().hex}.tmp"
+                self.current_file = open(temp_path, 'x', encoding='utf-8', buffering=WRITE_BUFFER_SIZE)
+                self.written_files.append((temp_path, file_path))
+                self.at_file_start = True
+        elif self.current_file:
+            if not self.at_file_start:
+                self.current_file.write("\n")
+            self.current_file.write(line)
+            self.at_file_start = False
+
+    def _close_current_file(self):
+        if self.current_file:
+            self.current_file.close()
+            self.current_file = None
+
+
+async def stream_ollama_response(client, model, context_tokens, prompt, spool_path, output_directory):
+    # Write the raw response to spool_path, and its #@{filename} blocks to output_directory, as tokens arrive
+    writer = ResultFilesWriter(output_directory)
+    try:
+        with open(spool_path, 'w', encoding='utf-8') as spool:
+            async with client.stream('POST', '/api/generate',
+                                     json={'model': model, 'prompt': prompt, 'stream': True,
+                                           'options': {'num_ctx': context_tokens}}) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line:
+                        continue
+                    chunk = json.loads(line)
+                    if 'error' in chunk:
+                        raise httpx.HTTPError(chunk['error'])
+                    spool.write(chunk['response'])
+                    writer.feed(chunk['response'])
+    except BaseException:
+        # Keep the previous output files, and leave the incomplete response out of the results file
+        writer.abort()
+        if os.path.exists(spool_path):
+            os.remove(spool_path)
+        raise
+    writer.close()
+
+
+def save_cached_ollama_response(cached_path, spool_path, output_directory):
+    # Same outputs as stream_ollama_response, read from the cache instead of the server
+    shutil.copyfile(cached_path, spool_path)
+    writer = ResultFilesWriter(output_directory)
+    try:
+        with open(cached_path, 'r', encoding='utf-8') as cached:
+            for line in cached:
+                writer.feed(line)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+
+
+def iter_spooled_responses(spool_paths):
+    # Failed responses have no spool file, and are left out
+    for index, spool_path in enumerate(path for path in spool_paths if os.path.exists(path)):
+        if index:
+            yield "\n"
+        with open(spool_path, 'r', encoding='utf-8') as spool:
+            yield from spool
+
+
+async def ask_ollama(requests, prompt_count, model, ollama_url, context_tokens, max_concurrent_requests,
+                     output_directory, cache_dir):
+    # Stream the (index, prompt, cache key, spool path) requests from the Ollama server, caching each response
+    async with httpx.AsyncClient(base_url=ollama_url, limits=OLLAMA_LIMITS, timeout=None) as client:
+        # Download the model if not cached
+        response = await client.post('/api/show', json={'model': model})
+        if response.status_code == 404:
+            print(f"Downloading Ollama model {model}...")
+            response = await client.post('/api/pull', json={'model': model, 'stream': False})
+        response.raise_for_status()
+
+        semaphore = asyncio.Semaphore(max_concurrent_requests)
+
+        async def ask(prompt, key, spool_path):
+            async with semaphore:
+                await stream_ollama_response(client, model, context_tokens, prompt, spool_path, output_directory)
+            with open(spool_path, 'r', encoding='utf-8') as spool:
+                store_cached_response(cache_dir, key, spool)
+
+        # Let every request finish while the client is still open, so a failing prompt
+        # does not cancel the others, which are still saved and cached
+        results = await asyncio.gather(
+            *(ask(prompt, key, spool_path) for _, prompt, key, spool_path in requests),
+            return_exceptions=True,
+        )
 
-    except subprocess.CalledProcessError as e:
-        print(f"Error running the Ollama model: {e}")
-        return ""
-    except EnvironmentError as e:
-        print(e)
-        return ""
+    for (index, _, _, _), result in zip(requests, results):
+        if isinstance(result, httpx.HTTPError):
+            print(f"Error running the Ollama model on prompt {index}/{prompt_count}: {result}")
+        elif isinstance(result, BaseException):
+            raise result
+
+
+async def use_local_llm(prompts, model, ollama_url, context_tokens, max_concurrent_requests, results_file,
+                        output_directory, cache_dir):
+    # Talk to the Ollama server over its HTTP API, reusing connections across requests.
+    # Responses are streamed to disk, so they are never held in memory as a whole.
+    with tempfile.TemporaryDirectory() as spool_directory:
+        spool_paths = [os.path.join(spool_directory, f"{index}.txt") for index in range(len(prompts))]
+
+        # Replay cached responses first, so the server is only needed for the prompts missing from the cache
+        uncached_requests = []
+        for index, (prompt, spool_path) in enumerate(zip(prompts, spool_paths), start=1):
+            key = cache_key('ollama', model, context_tokens, prompt)
+            cached_path = find_cached_response(cache_dir, key)
+            if cached_path:
+                save_cached_ollama_response(cached_path, spool_path, output_directory)
+            else:
+                uncached_requests.append((index, prompt, key, spool_path))
+
+        try:
+            if uncached_requests:
+                await ask_ollama(uncached_requests, len(prompts), model, ollama_url, context_tokens,
+                                 max_concurrent_requests, output_directory, cache_dir)
+        except httpx.ConnectError:
+            print(f"Could not reach the Ollama server at {ollama_url}. Please make sure it is running.")
+        except httpx.HTTPError as e:
+            print(f"Error running the Ollama model: {e}")
+
+        # Save the responses to the results file, in the same order as the prompts
+        save_to_file(iter_spooled_responses(spool_paths), results_file)
 
 
 def save_results(result_content, output_directory):
     """
     Save the results in separate files and directories as suggested by ChatGPT or the local LLM.
     It parses the content for file and folder structure based on #@{filename} markers.
+    The parsing is done by ResultFilesWriter, fed one slice at a time so the content is never split whole.
     """
-    lines = result_content.splitlines()
-    current_file = None
-    current_content = []
-    for line in lines:
-        if line.startswith("#@"):
-            if current_file:
-                # Save the current file
-                file_path = os.path.join(output_directory, current_file)
-                Path(os.path.dirname(file_path)).mkdir(parents=True, exist_ok=True)
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    f.write("\n".join(current_content))
-            # Start a new file
-            current_file = line[2:].strip()  # Extract filename after #@
-            current_content = []
-        else:
-            current_content.append(line)
+    writer = ResultFilesWriter(output_directory)
+    try:
+        for start in range(0, len(result_content), WRITE_BUFFER_SIZE):
+            writer.feed(result_content[start:start + WRITE_BUFFER_SIZE])
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
 
-    # Save the last file
-    if current_file:
-        file_path = os.path.join(output_directory, current_file)
-        Path(os.path.dirname(file_path)).mkdir(parents=True, exist_ok=True)
-        with open(file_path, 'w', encoding='utf-8') as f:
-            f.write("\n".join(current_content))
 
+# Same as separator.join(parts), yielding the pieces instead of building the joined string
+def iter_joined(separator, parts):
+    for index, part in enumerate(parts):
+        if index:
+            yield separator
+        yield part
 
+
+# Write a string, or an iterable of string chunks, to a file
 def save_to_file(content, file_path):
-    with open(file_path, 'w', encoding='utf-8') as f:
-        f.write(content)
+    if isinstance(content, str):
+        content = (content,)
+    with open(file_path, 'wb') as f:
+        for chunk in content:
+            # Encode in slices, so a large chunk never needs a second full copy as bytes
+            for start in range(0, len(chunk), ENCODE_SLICE_SIZE):
+                f.write(chunk[start:start + ENCODE_SLICE_SIZE].encode('utf-8'))
     print(f"Results saved to {file_path}")
 
 
@@ -224,39 +592,52 @@ def main():
 
     input_directory = config["input_directory"]
     code_extensions = config["code_extensions"]
-    all_code_content = read_and_concatenate_code_files(input_directory, code_extensions)
 
-    cleaned_code_content = clean_code_content(all_code_content)
-    prompt = generate_prompt(cleaned_code_content)
+    if config["clipboard_mode"]:
+        # Read and clean in a single pass, keeping the chunks so they are only joined once, for the clipboard
+        cleaned_code_chunks = list(clean_code_chunks(iter_code_chunks(input_directory, code_extensions)))
+        prompt_chunks = list(generate_prompt_chunks(cleaned_code_chunks))
 
-    # Save the prompt to a results file only once
-    save_to_file(prompt, config['results_file'])
+        # Save the prompt to a results file only once
+        save_to_file(prompt_chunks, config['results_file'])
 
-    if config["clipboard_mode"]:
         # Copy the content and prompt to the clipboard
-        clipboard_content = f"{prompt}\n\n{cleaned_code_content}"
+        clipboard_content = "".join([*prompt_chunks, "\n\n", *cleaned_code_chunks])
         pyperclip.copy(clipboard_content)
         print("The prompt and code have been copied to the clipboard for later use.")
-    elif config["local_llm"]:
-        # Use the local LLM model
+        return
+
+    # Use half of the token budget for the prompt, leaving the other half for the response.
+    # Ollama models have their own context window, which max_tokens of the OpenAI request does not reflect.
+    token_budget = config["ollama_context_tokens"] if config["local_llm"] else config["max_tokens"]
+    prompts = generate_batch_prompts(input_directory, code_extensions, token_budget // 2)
+
+    # Save the prompts to a results file only once
+    save_to_file(iter_joined("\n\n", prompts), config['results_file'])
+
+    if config["local_llm"]:
+        # Use the local LLM model, results are saved while they are generated
         print("Using local LLM model...")
-        improved_content = use_local_llm(prompt, config["ollama_model"])
-        save_to_file(improved_content, config['results_file'])
-        save_results(improved_content, config["output_dir"])
-    else:
-        # Normal mode, call OpenAI API
-        api_key = load_api_key(config['api_key_path'])
-        client = OpenAI(api_key=api_key)
-
-        output_directory = config["output_dir"]
-        improved_content = ask_openai_to_improve_code(client, prompt, config["model"], config["max_tokens"],
-                                                      config["temperature"])
-
-        # Save the improved content to the results file
-        save_to_file(improved_content, config['results_file'])
-
-        # Save the improved content to separate files
-        save_results(improved_content, output_directory)
+        asyncio.run(use_local_llm(prompts, config["ollama_model"], config["ollama_url"],
+                                  config["ollama_context_tokens"], config["max_concurrent_requests"], config['results_file'], config["output_dir"],
+                                  config["cache_dir"]))
+        evict_cache(config["cache_dir"], config["cache_max_size_mb"])
+        return
+
+    # Normal mode, call OpenAI API
+    api_key = load_api_key(config['api_key_path'])
+    client = AsyncOpenAI(api_key=api_key)
+    responses = asyncio.run(ask_openai_to_improve_code(client, prompts, config["model"], config["max_tokens"],
+                                                       config["temperature"], config["max_concurrent_requests"],
+                                                       config["cache_dir"]))
+    evict_cache(config["cache_dir"], config["cache_max_size_mb"])
+    improved_content = "\n".join(responses)
+
+    # Save the improved content to the results file
+    save_to_file(improved_content, config['results_file'])
+
+    # Save the improved content to separate files
+    save_results(improved_content, config["output_dir"])
 
 
 if __name__ == "__main__":